@@ -1,12 +1,17 @@
+import os
 import ssl
+import errno
 import socket
+import selectors
 import threading
 import logging.config
 from time import sleep
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 from src.logger import *
 from src.status import *
 from src.fileman import FileManager
-from src.structures import unified_socket, Request, Response
+from src.structures import unified_socket, Request, Response, ACCEPT_BR, ACCEPT_GZIP
 
 
 class HTTPyServer:
@@ -32,11 +37,29 @@ class HTTPyServer:
         # sockets
         self.port: int = port
         self.sock: unified_socket | None = None
+        self.selector: selectors.BaseSelector | None = None
         self.ctx: ssl.SSLContext | None = None
         if enable_ssl:
             self.ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER, check_hostname=False)
             self.ctx.load_cert_chain(certfile=certificate, keyfile=private_key)
 
+        # client handling threads
+        self._server_thread: threading.Thread | None = None
+        self._pool: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=Config.THREADING_MAX_NUMBER,
+            thread_name_prefix="httpy")
+
+        # selector of the connection the thread handles
+        self._local: threading.local = threading.local()
+
+        # request handlers
+        self._dispatch: dict[str, Callable[[Request], Response]] = {
+            "GET": self._handle_get,
+        }
+        self._not_implemented_response: Response = Response(
+            data=b'Not implemented :<',
+            status=STATUS_CODE_NOT_IMPLEMENTED)
+
         # signaling
         from signal import signal, SIGINT
         self._is_running: threading.Event = threading.Event()
@@ -63,6 +86,10 @@ class HTTPyServer:
         self.sock.bind(("0.0.0.0", self.port))
         self.sock.listen()
 
+        # wait for incoming connections instead of polling the socket
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+
     def start(self) -> None:
         """
         Starts the HTTPy Server
@@ -78,7 +105,8 @@ class HTTPyServer:
 
         # start server handle thread
         # maybe that will help with server dying?
-        threading.Thread(target=self._server_handle).start()
+        self._server_thread = threading.Thread(target=self._server_handle)
+        self._server_thread.start()
 
         # log
         logging.info(f"Server now running on '{': '.join(map(str, self.sock.getsockname()))}'")
@@ -96,6 +124,12 @@ class HTTPyServer:
         logging.info("Shutting the server down...")
 
         self._is_running.clear()
+
+        # stop accepting new clients, then let the pool finish the ones it has
+        if self._server_thread is not None:
+            self._server_thread.join()
+        self._pool.shutdown(wait=True)
+
         for thread in threading.enumerate():
             # skip main and daemon threads
             if thread is threading.main_thread() or thread.daemon:
@@ -103,6 +137,9 @@ class HTTPyServer:
             thread.join()
 
         # log
+        if self.ctx is not None:
+            stats = self.ctx.session_stats()
+            logging.info(f"SSL sessions: {stats['accept']} accepted, {stats['hits']} resumed")
         logging.info("Server shutdown.")
 
     def _server_handle(self):
@@ -112,34 +149,41 @@ class HTTPyServer:
 
         while self._is_running.is_set():
             client = self._accept()
-            sleep(Config.SOCKET_ACK_INTERVAL)
             if client is not None:
-                threading.Thread(target=self._client_handle, args=(client,)).start()
+                self._pool.submit(self._client_handle, client)
 
     def _client_handle(self, client: unified_socket):
         """
         Main client handle. Handles client connection request processing
         """
 
-        # try to fetch request
-        request = self._recv(client)
-        if request is None:
-            return
-
-        # get response
-        if request.type == "GET":
-            response = self._handle_get(request)
-        else:
-            response = Response(data=b'Not implemented :<', status=STATUS_CODE_NOT_IMPLEMENTED)
-
-        # modify header to close
-        response.headers["Connection"] = "close"
-
-        # send response
-        self._send(client, response)
-
-        # close connection
-        client.close()
+        selector: selectors.BaseSelector | None = None
+        try:
+            # wait for client readiness using connection's own selector
+            client.setblocking(False)
+            selector = selectors.DefaultSelector()
+            selector.register(client, selectors.EVENT_READ)
+            self._local.selector = selector
+
+            # try to fetch request
+            request = self._recv(client)
+            if request is None:
+                return
+
+            # get response
+            handler = self._dispatch.get(request.type)
+            response = handler(request) if handler else self._not_implemented_response
+
+            # send response
+            self._send(client, response)
+        except Exception:  # pool workers keep exceptions in discarded futures -> log them here
+            logging.exception("Exception while handling client")
+        finally:
+            # close connection (and selector, so idle threads don't keep file descriptors)
+            self._local.selector = None
+            if selector is not None:
+                selector.close()
+            client.close()
 
     def _handle_get(self, request: Request) -> Response:
         """
@@ -148,33 +192,23 @@ class HTTPyServer:
         :return: response to request
         """
 
-        # supported compressions
-        encodings = [x.strip() for x in getattr(request, "Accept-Encoding", "").split(",")]
-
-        if self.fileman.exists(request.path):
-            container = self.fileman.get_container(request.path)
-            headers = {"Content-Type": container.uncompressed.filetype, "Content-Length": container.uncompressed.size}
-            data_stream = container.uncompressed.get_data_stream()
+        container = self.fileman.find_container(request.path_bytes)
+        if container is not None:
+            file = container.uncompressed
             if container.compressed:
-                if "br" in encodings:  # brotli encoding (preferred)
-                    headers["Content-Encoding"] = "br"
-                    headers["Content-Length"] = container.brotli_compressed.size
-                    data_stream = container.brotli_compressed.get_data_stream()
-                elif "gzip" in encodings:  # gzip encoding
-                    headers["Content-Encoding"] = "gzip"
-                    headers["Content-Length"] = container.gzip_compressed.size
-                    data_stream = container.gzip_compressed.get_data_stream()
+                if request.accept_encoding & ACCEPT_BR:  # brotli encoding (preferred)
+                    file = container.brotli_compressed
+                elif request.accept_encoding & ACCEPT_GZIP:  # gzip encoding
+                    file = container.gzip_compressed
             return Response(
-                data_stream=data_stream,
+                file=file,
                 status=STATUS_CODE_OK,
-                headers=headers)
+                header_block=file.header_block)
         else:
-            error = self.fileman.get_container("/err/response").uncompressed.get_full_data().decode("utf-8")
-            error = error.format(
-                status_code="404 Not Found",
-                error_message=f"Page at '{request.path[1:]}' not found :<")
             return Response(
-                data=error.encode("utf-8"),
+                data=self.fileman.make_error_page(
+                    status_code=STATUS_CODE_NOT_FOUND,
+                    error_message=f"Page at '{request.path[1:]}' not found :<"),
                 status=STATUS_CODE_NOT_FOUND)
 
     def _send(self, client: unified_socket, response: Response) -> None:
@@ -184,15 +218,117 @@ class HTTPyServer:
         :param response: response
         """
 
-        for data in response.get_data_stream():
-            sent = 0
-            while sent < len(data):
+        # hold partial packets, so headers go out together with the start of the body
+        self._set_cork(client, True)
+        try:
+            # files on the drive are sent directly from the kernel (not possible with SSL)
+            file = response.file
+            if file is not None and not file.cached and self.ctx is None and hasattr(os, "sendfile"):
+                if self._send_data(client, response.get_header_data()):
+                    self._sendfile(client, file.filepath, file.size)
+                return
+
+            # gather headers and body chunks into batches, sent with single syscall each
+            if self.ctx is None and hasattr(socket.socket, "sendmsg"):
+                batch = []
+                batch_size = 0
+                for data in response.get_data_stream():
+                    batch.append(data)
+                    batch_size += len(data)
+                    if batch_size >= Config.SOCKET_SEND_SIZE:
+                        if not self._send_buffers(client, batch):
+                            return
+                        batch = []
+                        batch_size = 0
+                if batch:
+                    self._send_buffers(client, batch)
+                return
+
+            for data in response.get_data_stream():
+                if not self._send_data(client, data):
+                    return
+        finally:
+            self._set_cork(client, False)
+
+    @staticmethod
+    def _set_cork(client: unified_socket, enabled: bool) -> None:
+        """
+        Sets TCP_CORK on client connection (Linux only). Uncorking flushes held data
+        :param client: client connection
+        :param enabled: cork or uncork
+        """
+
+        if not hasattr(socket, "TCP_CORK"):
+            return
+        try:
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, int(enabled))
+        except OSError:
+            pass
+
+    def _send_data(self, client: unified_socket, data: bytes) -> bool:
+        """
+        Sends all data to client
+        :param client: client connection
+        :param data: data to send
+        :return: True if data was sent, False if connection failed
+        """
+
+        sent = 0
+        while sent < len(data):
+            try:
+                sent += client.send(data[sent:])
+            except (ssl.SSLWantWriteError, BlockingIOError):
+                self._wait(client, selectors.EVENT_WRITE)
+            except (ssl.SSLError, OSError):
+                return False
+        return True
+
+    def _send_buffers(self, client: unified_socket, buffers: list[bytes]) -> bool:
+        """
+        Sends all buffers to client using sendmsg, which writes multiple buffers at once (not possible with SSL)
+        :param client: client connection
+        :param buffers: list of data to send
+        :return: True if data was sent, False if connection failed
+        """
+
+        views = [memoryview(buffer) for buffer in buffers]
+        while views:
+            try:
+                sent = client.sendmsg(views)
+            except BlockingIOError:
+                self._wait(client, selectors.EVENT_WRITE)
+                continue
+            except OSError:
+                return False
+
+            # drop fully sent buffers, and cut partially sent one
+            while views and sent >= len(views[0]):
+                sent -= len(views.pop(0))
+            if views:
+                views[0] = views[0][sent:]
+        return True
+
+    def _sendfile(self, client: unified_socket, filepath: str, size: int) -> None:
+        """
+        Sends file to client using sendfile syscall
+        :param client: client connection
+        :param filepath: path to file
+        :param size: number of bytes to send
+        """
+
+        with open(filepath, "rb") as file:
+            offset = 0
+            while offset < size:
                 try:
-                    sent += client.send(data[sent:])
-                except (ssl.SSLWantWriteError, BlockingIOError):
-                    sleep(Config.SOCKET_ACK_INTERVAL)
-                except (ssl.SSLError, OSError):
+                    sent = os.sendfile(client.fileno(), file.fileno(), offset, size - offset)
+                except BlockingIOError:
+                    self._wait(client, selectors.EVENT_WRITE)
+                    continue
+                except OSError:
                     return
+                if sent == 0:  # file got shorter
+                    return
+                offset += sent
 
     def _recv(self, client: unified_socket) -> Request:
         """
@@ -201,19 +337,47 @@ class HTTPyServer:
         :return: request
         """
 
-        buffer = bytearray()
+        chunks: list[bytes] = []
+        total = 0
+        tail = b''  # last 3 bytes of received data
+        recv_buffer = memoryview(bytearray(Config.SOCKET_RECV_SIZE))  # reused for every read of the connection
         while self._is_running.is_set():
-            size = len(buffer)
             try:
-                buffer += client.recv(Config.SOCKET_RECV_SIZE)
+                size = client.recv_into(recv_buffer)
             except (ssl.SSLWantReadError, BlockingIOError):
-                sleep(Config.SOCKET_ACK_INTERVAL)
+                self._wait(client, selectors.EVENT_READ)
+                continue
             except (ssl.SSLError, OSError):
                 break
-            if buffer[-4:] == b'\r\n\r\n':
-                return Request(buffer)
-            if size == len(buffer) or size > Config.HTTP_MAX_RECV_SIZE:
+            if size == 0:
+                break
+            chunk = recv_buffer[:size].tobytes()
+            chunks.append(chunk)
+            total += size
+
+            # find the end of headers, which may be split between chunks
+            index = (tail + chunk[:3]).find(b'\r\n\r\n')
+            if index == -1 and (index := chunk.find(b'\r\n\r\n')) != -1:
+                index += len(tail)
+            if index != -1:
+                data = b''.join(chunks)
+                end = total - size - len(tail) + index + 4
+                return Request(data[:end], body=data[end:])
+            if total > Config.HTTP_MAX_RECV_SIZE:
                 break
+            tail = (tail + chunk[-3:])[-3:]
+
+    def _wait(self, client: unified_socket, events: int) -> None:
+        """
+        Waits until client connection is ready, or until poll timeout runs out
+        :param client: client connection (registered in connection's selector)
+        :param events: selectors.EVENT_READ and / or selectors.EVENT_WRITE
+        """
+
+        selector = self._local.selector
+        if selector.get_key(client).events != events:
+            selector.modify(client, events)
+        selector.select(timeout=Config.SOCKET_POLL_TIMEOUT)
 
     def _accept(self) -> unified_socket | None:
         """
@@ -221,12 +385,10 @@ class HTTPyServer:
         """
 
         while self._is_running.is_set():
-            if len(threading.enumerate()) > Config.THREADING_MAX_NUMBER:
-                continue
             try:
                 return self.sock.accept()[0]
             except BlockingIOError:
-                sleep(Config.SOCKET_ACK_INTERVAL)
+                self.selector.select(timeout=Config.SOCKET_POLL_TIMEOUT)
             except ssl.SSLError as e:
                 if e.reason not in [
                     "HTTP_REQUEST",
@@ -237,6 +399,13 @@ class HTTPyServer:
                     "UNEXPECTED_EOF_WHILE_READING",
                 ]:
                     raise
+            except OSError as e:
+                if e.errno not in (errno.EMFILE, errno.ENFILE):
+                    raise
+                # out of file descriptors -> wait for other connections to close.
+                # listening socket stays readable here, so selector wouldn't wait
+                logging.warning(f"Unable to accept connection: {e.strerror}")
+                sleep(Config.SOCKET_POLL_TIMEOUT)
 
 
 def parse_args():
@@ -10,7 +10,7 @@ class Config:
     # sockets
     SOCKET_RECV_SIZE: int
     SOCKET_SEND_SIZE: int
-    SOCKET_ACK_INTERVAL: float
+    SOCKET_POLL_TIMEOUT: float
 
     # logging
     LOGGING_PATH: str
@@ -4,23 +4,32 @@ File Manager for controlling access to files
 
 
 import os
+import re
 from logging import Logger
 from collections.abc import Generator
+from concurrent.futures import ThreadPoolExecutor
 from src.config import Config
+from src.status import StatusCode
 
 
-def list_directory(dirpath: str) -> list[str]:
+def list_directory(dirpath: str) -> list[tuple[str, int]]:
     """
     Lists all file in given directory. Returns single file if dirpath is path to a file
     :param dirpath: path to directory
-    :return: list of paths to files
+    :return: list of paths to files and their sizes
     """
 
     if os.path.isfile(dirpath):  # if dirpath is a file -> return
-        return [dirpath]
+        return [(dirpath, os.path.getsize(dirpath))]
     paths = []
-    for file in os.listdir(dirpath):
-        paths += list_directory(os.path.join(dirpath, file))
+    stack = [dirpath]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:  # entry types come from the directory listing itself, no extra stat
+                if entry.is_dir():
+                    stack.append(entry.path)
+                else:
+                    paths.append((entry.path, entry.stat().st_size))
     return paths
 
 
@@ -29,27 +38,46 @@ class File:
     File
     """
 
-    def __init__(self, filepath: str, cached: bool = False):
-        if not os.path.isfile(filepath):
+    def __init__(
+            self,
+            filepath: str,
+            cached: bool = False,
+            encoding: str | None = None,
+            filesize: int | None = None):
+        if filesize is None and not os.path.isfile(filepath):  # known size -> file was already found
             raise FileNotFoundError(f"File '{filepath}' doesn't exist")
 
         self._filepath: str = filepath
         self._filetype: str = "*/*"
         self._filesize: int = 0
+        self._encoding: str | None = encoding
+        self._header_block: bytes = b''
         self._cached: bytes | None = b'empty' if cached else None
 
         self._define_type()
-        self.update_file()
+        self.update_file(filesize)
 
-    def update_file(self) -> None:
+    def update_file(self, filesize: int | None = None) -> None:
         """
         Updates data inside a file
+        :param filesize: size of the file, if it's already known
         """
 
         if self._cached is not None:
             with open(self._filepath, "rb") as file:
                 self._cached = file.read()
-        self._filesize = os.path.getsize(self._filepath)
+        self._filesize = os.path.getsize(self._filepath) if filesize is None else filesize
+        self._update_header_block()
+
+    def _update_header_block(self) -> None:
+        """
+        Precomputes HTTP headers for self
+        """
+
+        header_block = f"Content-Type: {self._filetype}\r\nContent-Length: {self._filesize}\r\n"
+        if self._encoding is not None:
+            header_block += f"Content-Encoding: {self._encoding}\r\n"
+        self._header_block = header_block.encode("ascii")
 
     def _define_type(self) -> None:
         """
@@ -116,14 +144,22 @@ class File:
     def size(self) -> int:
         return self._filesize
 
+    @property
+    def cached(self) -> bool:
+        return self._cached is not None
+
+    @property
+    def header_block(self) -> bytes:
+        return self._header_block
+
 
 class FileContainer:
     """
     Contains multiple files inside
     """
 
-    def __init__(self, filepath: str, compress: bool = True, cache: bool = False):
-        self.uncompressed: File = File(filepath, cached=cache)
+    def __init__(self, filepath: str, compress: bool = True, cache: bool = False, filesize: int | None = None):
+        self.uncompressed: File = File(filepath, cached=cache, filesize=filesize)
         self.compressed: bool = compress
 
         if compress:  # if compression is enabled
@@ -134,7 +170,7 @@ class FileContainer:
                     os.makedirs(os.path.dirname(c_filepath))
                 with open(c_filepath, "wb") as f:
                     f.write(b'file')
-            self.gzip_compressed: File = File(c_filepath, cached=cache)
+            self.gzip_compressed: File = File(c_filepath, cached=cache, encoding="gzip")
 
             # brotli compression
             c_filepath = os.path.join(Config.FILEMAN_COMPRESS_PATH, "brotli", filepath)
@@ -143,10 +179,22 @@ class FileContainer:
                     os.makedirs(os.path.dirname(c_filepath))
                 with open(c_filepath, "wb") as f:
                     f.write(b'file')
-            self.brotli_compressed: File = File(c_filepath, cached=cache)
+            self.brotli_compressed: File = File(c_filepath, cached=cache, encoding="br")
+
+            # files are compressed later with 'compress_files' (see FileManager.update_paths)
+
+    def is_outdated(self) -> bool:
+        """
+        Checks if compressed files were made from a different version of the uncompressed file.
+        Compressed files get the modification time of the uncompressed one after compression
+        """
 
-            # actually compress files
-            self.compress_files()
+        if not self.compressed:
+            return False
+
+        mtime = os.stat(self.uncompressed.filepath).st_mtime_ns
+        return (os.stat(self.gzip_compressed.filepath).st_mtime_ns != mtime or
+                os.stat(self.brotli_compressed.filepath).st_mtime_ns != mtime)
 
     def compress_files(self) -> None:
         """
@@ -163,11 +211,19 @@ class FileContainer:
             with open(self.uncompressed.filepath, "rb") as file:
                 compressed.writelines(file)
         with open(self.brotli_compressed.filepath, "wb") as compressed:
-            br = brotli.Compressor()
+            br = brotli.Compressor(
+                mode=brotli.MODE_TEXT if self.uncompressed.filetype.startswith("text/") else brotli.MODE_GENERIC,
+                quality=11)
             with open(self.uncompressed.filepath, "rb") as file:
                 while data := file.read(chunk_size):
-                    br.process(data)
-                    compressed.write(br.flush())
+                    compressed.write(br.process(data))
+            compressed.write(br.finish())
+
+        # mark compressed files as up-to-date, and update their sizes / cached data
+        mtime = os.stat(self.uncompressed.filepath).st_mtime_ns
+        for file in (self.gzip_compressed, self.brotli_compressed):
+            os.utime(file.filepath, ns=(mtime, mtime))
+            file.update_file()
 
 
 class FileManager:
@@ -188,6 +244,11 @@ class FileManager:
 
         self._path_map: dict[str, FileContainer] = dict()
         # {webpath: FileContainer, webpath: FileContainer, ...}
+        self._path_map_bytes: dict[bytes, FileContainer] = dict()
+        # same as path map, but with raw request paths
+
+        self._error_template: list[bytes] | None = None
+        # [text, placeholder, text, placeholder, ..., text]
 
         self._allow_compression: bool = allow_compression
         self._cache_everything: bool = cache_everything
@@ -213,12 +274,13 @@ class FileManager:
                 if not os.path.exists(real_dirpath) and self._logger:  # file not found
                     self._logger.warning(f"Unable to find directory at '{real_dirpath}'")
                     continue
-                for filepath in list_directory(real_dirpath):
+                for filepath, filesize in list_directory(real_dirpath):
                     web_filepath = f"{web_dirpath}{filepath[len(real_dirpath):]}"
                     if self._logger:  # log processed path
                         self._logger.info(f"Processed '{web_filepath}' -> '{filepath}'")
                     self._path_map[web_filepath] = FileContainer(
                         filepath=filepath,
+                        filesize=filesize,
                         compress=val.get("compress", True) if self._allow_compression else False,
                         cache=val.get("cache", False) if not self._cache_everything else True)
             else:  # direct path
@@ -231,6 +293,37 @@ class FileManager:
                     filepath=val["path"],
                     compress=val.get("compress", True) if self._allow_compression else False,
                     cache=val.get("cache", False) if not self._cache_everything else True)
+
+        # compress files (unless they are left from previous run), each file on its own thread.
+        # zlib and brotli release the GIL while compressing, so threads run on all cores
+        # several webpaths may point to the same file -> group them, and compress each file only once
+        outdated: dict[str, list[FileContainer]] = dict()
+        # {filepath: [FileContainer, FileContainer, ...], ...}
+        for container in self._path_map.values():
+            if container.is_outdated():
+                outdated.setdefault(os.path.normpath(container.uncompressed.filepath), []).append(container)
+        if outdated:
+            if self._logger:
+                self._logger.info(f"Compressing {len(outdated)} files...")
+            with ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="fileman") as executor:
+                list(executor.map(FileContainer.compress_files, [group[0] for group in outdated.values()]))
+
+            # pick up compressed files in the rest of the group
+            for group in outdated.values():
+                for container in group[1:]:
+                    container.gzip_compressed.update_file()
+                    container.brotli_compressed.update_file()
+
+        # lookup by raw request path (skips decoding on every request)
+        self._path_map_bytes = {key.encode("utf-8"): val for key, val in self._path_map.items()}
+
+        # error page template
+        if self.exists("/err/response"):
+            template = self.get_container("/err/response").uncompressed.get_full_data()
+            self._error_template = re.split(rb"\{(status_code|error_message)}", template)
+        elif self._logger:
+            self._logger.warning("Unable to find error page template at '/err/response'")
+
         if self._logger:
             self._logger.info("Paths updated.")
 
@@ -254,3 +347,28 @@ class FileManager:
         if self.exists(webpath):
             return self._path_map[webpath]
         raise KeyError("Path not found")
+
+    def find_container(self, webpath: bytes) -> FileContainer | None:
+        """
+        Returns a file container by raw request path
+        :param webpath: client's raw request path
+        :return: FileContainer or None when path is not found
+        """
+
+        return self._path_map_bytes.get(webpath)
+
+    def make_error_page(self, status_code: StatusCode, error_message: str) -> bytes:
+        """
+        Makes an error page using '/err/response' template
+        :param status_code: response status code
+        :param error_message: error message to display
+        :return: page data
+        """
+
+        if self._error_template is None:
+            return f"{status_code}: {error_message}".encode("utf-8")
+        values = {b'status_code': bytes(status_code), b'error_message': error_message.encode("utf-8")}
+        page = self._error_template.copy()
+        for i in range(1, len(page), 2):  # odd parts are placeholders
+            page[i] = values[page[i]]
+        return b''.join(page)
@@ -11,6 +11,7 @@ class StatusCode:
     def __init__(self, code: int, message: str):
         self._code: int = code
         self._message: str = message
+        self._status_line: bytes = f"HTTP/1.1 {code} {message}\r\n".encode("utf8")
 
     def __bytes__(self):
         return f"{self._code} {self._message}".encode("utf8")
@@ -26,6 +27,10 @@ class StatusCode:
     def message(self) -> str:
         return self._message
 
+    @property
+    def status_line(self) -> bytes:
+        return self._status_line
+
 
 # Status codes!
 # 2xx
@@ -7,21 +7,36 @@ from ssl import SSLSocket
 from socket import socket
 from collections.abc import Iterable, Generator
 from src.config import Config
+from src.fileman import File
 from src.status import StatusCode, STATUS_CODE_NOT_FOUND, STATUS_CODE_OK
 
 
 unified_socket = SSLSocket | socket
 
 
+# supported content encodings (Accept-Encoding flags)
+ACCEPT_BR = 1
+ACCEPT_GZIP = 2
+
+# server closes every connection after the response
+HEADER_CONNECTION_CLOSE = b'Connection: close\r\n'
+
+
 class Request:
     """
     HTTP request
     """
 
-    def __init__(self, raw_http: bytes):
+    __slots__ = ("_type", "_path", "_path_bytes", "_path_args", "_headers", "_accept_encoding", "_body")
+
+    def __init__(self, raw_http: bytes, body: bytes = b''):
         self._type: str = ""
-        self._path: str = ""
+        self._path: str | None = None  # decoded on demand from path bytes
+        self._path_bytes: bytes = b''
         self._path_args: dict[str, str] = dict()
+        self._headers: dict[str, str] = dict()  # {lowercase header name: value}
+        self._accept_encoding: int = 0  # ACCEPT_BR | ACCEPT_GZIP flags
+        self._body: bytes = body  # part of the body received along with headers
 
         self._construct(raw_http)
 
@@ -30,40 +45,72 @@ class Request:
         Constructs self from raw http data
         """
 
-        # get type
-        index = raw_http.find(b' ', 0, 10)
-        if index == -1:
+        # request line separators
+        type_end = raw_http.find(b' ', 0, 10)
+        if type_end == -1:
+            return None
+        path_end = raw_http.find(b' ', type_end + 1, type_end + 1 + Config.HTTP_MAX_PATH_LENGTH)
+        if path_end == -1:
             return None
-        self._type = raw_http[:index].decode("ascii")
+        line_end = raw_http.find(b'\r\n', path_end + 1)
+        if line_end == -1:
+            return None
+
+        # get type
+        self._type = raw_http[:type_end].decode("ascii")
 
         # get path
-        index = raw_http.find(b' ', len(self._type) + 1, Config.HTTP_MAX_PATH_LENGTH + len(self._type))
-        if index == -1:
-            return None
-        raw_path = raw_http[len(self._type) + 1:index].decode("ascii")
-        q_split = raw_path.split("?", maxsplit=1)
-        self._path = q_split[0]
+        raw_path = raw_http[type_end + 1:path_end]
+        q_split = raw_path.split(b"?", maxsplit=1)
+        self._path_bytes = q_split[0]
 
         # get args
-        raw_args = q_split[1] if len(q_split) == 2 else ""
+        raw_args = q_split[1].decode("ascii") if len(q_split) == 2 else ""
         for raw_arg in raw_args.split("&", maxsplit=Config.HTTP_MAX_ARG_NUMBER):
             split = raw_arg.split("=", maxsplit=1)
             if len(split) == 2:  # if there is a key value pair present
                 self._path_args[split[0]] = split[1]
 
         # get headers
-        header_data = raw_http.split(b'\r\n', maxsplit=Config.HTTP_MAX_HEADER_NUMBER)
-        for raw_header in header_data:
-            if len(pair := raw_header.decode("utf8").split(":", maxsplit=1)) == 2:
-                key, val = pair
-                val = val.strip()
+        header_data = raw_http[line_end + 2:].decode("utf8").split("\r\n", maxsplit=Config.HTTP_MAX_HEADER_NUMBER)
+        self._headers = {
+            key.lower(): val.strip()
+            for key, sep, val in (raw_header.partition(":") for raw_header in header_data)
+            if sep}
 
-                # check attribute
-                if key in self.__dict__:
-                    return None
+        # parse supported encodings once
+        self._accept_encoding = self._parse_accept_encoding(self._headers.get("accept-encoding", ""))
+
+    @staticmethod
+    def _parse_accept_encoding(value: str) -> int:
+        """
+        Parses Accept-Encoding header value into encoding flags
+        :param value: header value
+        :return: ACCEPT_BR | ACCEPT_GZIP flags
+        """
 
-                # set attribute to key value pair
-                setattr(self, key, val)
+        flags = 0
+        for encoding in value.split(","):
+            name, _, params = encoding.partition(";")
+
+            # skip encodings the client refused ('q=0')
+            refused = False
+            for param in params.split(";"):
+                key, _, val = param.partition("=")
+                if key.strip().lower() == "q":
+                    try:
+                        refused = float(val) == 0
+                    except ValueError:  # malformed weight -> don't use the encoding
+                        refused = True
+            if refused:
+                continue
+
+            match name.strip():
+                case "br":
+                    flags |= ACCEPT_BR
+                case "gzip":
+                    flags |= ACCEPT_GZIP
+        return flags
 
     @property
     def type(self) -> str:
@@ -71,14 +118,32 @@ class Request:
 
     @property
     def path(self) -> str:
+        if self._path is None:
+            self._path = self._path_bytes.decode("ascii", errors="replace")
         return self._path
 
+    @property
+    def headers(self) -> dict[str, str]:
+        return self._headers
+
+    @property
+    def accept_encoding(self) -> int:
+        return self._accept_encoding
+
+    @property
+    def path_bytes(self) -> bytes:
+        return self._path_bytes
+
     @property
     def args(self) -> dict[str, str]:
         return self._path_args
 
+    @property
+    def body(self) -> bytes:
+        return self._body
+
     def __str__(self) -> str:
-        return '\n'.join([f"{key}: {val}" for key, val in self.__dict__.items()])
+        return '\n'.join([f"{key}: {getattr(self, key)}" for key in self.__slots__])
 
 
 class Response:
@@ -86,37 +151,61 @@ class Response:
     HTTP response
     """
 
+    __slots__ = ("data", "_data_stream", "_file", "_status", "headers", "header_block")
+
     def __init__(
             self,
             data: bytes | None = None,
             data_stream: Iterable | None = None,
+            file: File | None = None,
             status: StatusCode | None = None,
-            headers: dict[str, str] | None = None):
+            headers: dict[str, str] | None = None,
+            header_block: bytes = b''):
         self.data: bytes | None = data
         self._data_stream: Iterable | None = data_stream
+        self._file: File | None = file
         self._status: StatusCode | None = status
         self.headers: dict[str, str] | None = headers if headers else dict()
+        self.header_block: bytes = header_block  # preformatted headers
+        if self.data is not None:
+            self.header_block += b'Content-Length: %d\r\n' % len(self.data)
 
-        if self.data is None and self._data_stream is None:  # data not present
+        if self.data is None and self._data_stream is None and self._file is None:  # data not present
             self._status = STATUS_CODE_NOT_FOUND
         elif self._status is None:  # data present, but no status code
             self._status = STATUS_CODE_OK
 
-    def get_data_stream(self) -> Generator[bytes, None, None]:
-        msg = b'HTTP/1.1 ' + self._status.__bytes__() + b'\r\n'
+    def get_header_data(self) -> bytes:
+        """
+        Returns status line and headers of the response
+        """
+
+        msg = [self._status.status_line, self.header_block]
         for key, val in self.headers.items():
-            msg += f"{key}: {val}\r\n".encode("utf-8")
-        yield msg + b'\r\n'
+            msg.append(f"{key}: {val}\r\n".encode("utf-8"))
+        msg.append(HEADER_CONNECTION_CLOSE)
+        msg.append(b'\r\n')
+        return b''.join(msg)
+
+    def get_data_stream(self) -> Generator[bytes, None, None]:
+        yield self.get_header_data()
         if self._data_stream is not None:
             for val in self._data_stream:
                 yield val
+        elif self._file is not None:
+            for val in self._file.get_data_stream():
+                yield val
         elif self.data is not None:
             for i in range(0, len(self.data), Config.SOCKET_SEND_SIZE):
                 yield self.data[i:i + Config.SOCKET_SEND_SIZE]
 
+    @property
+    def file(self) -> File | None:
+        return self._file
+
     @property
     def status(self) -> StatusCode:
         return self._status
 
     def __str__(self) -> str:
-        return '\n'.join([f"{key}: {val}" for key, val in self.__dict__.items()])
+        return '\n'.join([f"{key}: {getattr(self, key)}" for key in self.__slots__])